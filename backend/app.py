@@ -4,113 +4,439 @@ QuMail Backend - Quantum Key Distribution (QKD) Key Manager
 Provides a QKD Key Manager API for quantum-secure email communications.
 
 Installation:
-pip install flask flask-cors pycryptodome python-dotenv
+pip install flask flask-cors python-dotenv orjson
 
 Usage:
-python app.py
+python app.py                      # development server
+gunicorn --preload --pythonpath backend -k gthread --threads 4 -b 0.0.0.0:5001 wsgi:app
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-from Crypto.Random import get_random_bytes
 import sqlite3
+import queue
+import threading
+import atexit
+from collections import OrderedDict
+from contextlib import closing, contextmanager
 import base64
-import secrets
+from binascii import b2a_base64
 import datetime
+import time
 import os
+import orjson
 
 # --- Flask app setup ---
+class OrjsonProvider(DefaultJSONProvider):
+    """Serve request and response JSON through orjson, writing response bodies straight to bytes"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default), mimetype=self.mimetype)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)  # Enable CORS for frontend
 
 # --- Configuration ---
 DATABASE = 'backend/qkd_keys.db'
 API_PORT = 5001
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 4))  # idle connections kept open per worker; match gunicorn --threads
+MAX_BATCH_KEYS = 100  # upper bound on keys per /api/get_keys or /api/request_keys call
+MAX_KEY_LIFETIME = 30 * 86400  # longest key lifetime a client may request, in seconds
+KEY_ALGORITHMS = ('AES-256-GCM', 'ChaCha20-Poly1305')  # AEADs a client may record for a key; the first is the default
+KEY_CACHE_SIZE = 1024  # active keys kept in memory per process
+AUDIT_FLUSH_INTERVAL = 0.01  # seconds the audit writer waits for more rows before committing
+AUDIT_BATCH_SIZE = 500  # max key_usage_log rows per audit transaction
+EXPIRY_SWEEP_INTERVAL = 60  # seconds between bulk expiry sweeps of qkd_keys
+WAL_CHECKPOINT_INTERVAL = 3600  # seconds between PRAGMA wal_checkpoint(TRUNCATE) runs
+OPTIMIZE_INTERVAL = 86400  # seconds between PRAGMA optimize runs
+
+# Connection-scoped PRAGMAs, applied to every connection we open.
+# journal_mode=WAL is persistent in the database file and is set once in init_database().
+SQLITE_PRAGMAS = (
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA journal_size_limit=6144000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-20000',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA foreign_keys=ON',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA wal_autocheckpoint=1000',
+)
+
+# --- SQL statements ---
+SQL_CREATE_KEYS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        key_id TEXT PRIMARY KEY,
+        key_bytes BLOB NOT NULL,
+        sender TEXT NOT NULL,
+        recipient TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        expires_at TEXT NOT NULL,
+        expires_at_epoch INTEGER NOT NULL,
+        status TEXT DEFAULT 'active',
+        algorithm TEXT DEFAULT 'AES-256-GCM',
+        key_length INTEGER DEFAULT 256
+    )
+'''
+KEY_COLUMNS = 'key_id, key_bytes, sender, recipient, created_at, expires_at, expires_at_epoch, status, algorithm, key_length'
+
+# Shared by every pooled connection so each one compiles a statement once and
+# then serves it from its statement cache.
+SQL_INSERT_KEY = '''
+    INSERT INTO qkd_keys (key_id, key_bytes, sender, recipient, created_at, expires_at, expires_at_epoch, algorithm)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+SQL_INSERT_LOG = '''
+    INSERT INTO key_usage_log (key_id, action, timestamp, details)
+    VALUES (?, ?, ?, ?)
+'''
+SQL_SELECT_KEYS = '''
+    SELECT key_id, key_bytes, sender, recipient, created_at, expires_at, status, algorithm, expires_at_epoch
+    FROM qkd_keys WHERE key_id IN ({placeholders})
+'''
+SQL_EXPIRE_KEY = "UPDATE qkd_keys SET status='expired' WHERE key_id = ?"
+SQL_EXPIRE_STALE_KEYS = '''
+    UPDATE qkd_keys SET status='expired'
+    WHERE status='active' AND expires_at_epoch < ?
+'''
+SQL_HAS_STALE_KEYS = '''
+    SELECT 1 FROM qkd_keys WHERE status='active' AND expires_at_epoch < ? LIMIT 1
+'''
+SQL_LIST_KEYS = '''
+    SELECT key_id, sender, recipient, created_at, expires_at, status, algorithm, expires_at_epoch
+    FROM qkd_keys ORDER BY created_at DESC LIMIT 50
+'''
+# Keys where the user is sender OR recipient. Written as UNION ALL of two
+# index range scans (each leg capped at LIMIT) because SQLite cannot serve an
+# OR across two columns with ORDER BY ... LIMIT from a single index.
+SQL_LIST_USER_KEYS = '''
+    SELECT key_id, sender, recipient, created_at, expires_at, status, algorithm, expires_at_epoch FROM (
+        SELECT * FROM (
+            SELECT key_id, sender, recipient, created_at, expires_at, status, algorithm, expires_at_epoch
+            FROM qkd_keys WHERE sender = ? ORDER BY created_at DESC LIMIT 50
+        )
+        UNION ALL
+        SELECT * FROM (
+            SELECT key_id, sender, recipient, created_at, expires_at, status, algorithm, expires_at_epoch
+            FROM qkd_keys WHERE recipient = ? AND sender <> ? ORDER BY created_at DESC LIMIT 50
+        )
+    ) ORDER BY created_at DESC LIMIT 50
+'''
 
 # --- Database initialization ---
+def connect_db():
+    """Open a SQLite connection with the tuned PRAGMAs applied"""
+    # isolation_level=None: transactions are opened explicitly by write_transaction()
+    conn = sqlite3.connect(DATABASE, check_same_thread=False, isolation_level=None,
+                           cached_statements=256)
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+@contextmanager
+def write_transaction(conn):
+    """Run a block inside BEGIN IMMEDIATE so the write lock is taken up front"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn.cursor()
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+# --- Connection pool ---
+# Connections are opened on demand and returned to the pool at the end of each
+# request, so the page cache and statement cache survive across requests.
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+def get_db():
+    """Borrow a pooled connection for the current request"""
+    db = getattr(g, '_database', None)
+    if db is None:
+        try:
+            db = _db_pool.get_nowait()
+        except queue.Empty:
+            db = connect_db()
+        g._database = db
+    return db
+
+@app.teardown_appcontext
+def close_connection(exception):
+    db = g.pop('_database', None)
+    if db is None:
+        return
+    if db.in_transaction:
+        db.rollback()
+    try:
+        _db_pool.put_nowait(db)
+    except queue.Full:
+        db.close()
+
+@atexit.register
+def close_pool():
+    while True:
+        try:
+            _db_pool.get_nowait().close()
+        except queue.Empty:
+            break
+
+def request_time():
+    """Return (epoch seconds, ISO-8601 string) for the current request, formatted once"""
+    now = getattr(g, '_request_time', None)
+    if now is None:
+        ts = time.time()
+        now = g._request_time = (ts, datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).isoformat().replace('+00:00', 'Z'))
+    return now
+
+# --- Audit log writer ---
+# key_usage_log rows are queued and written in batches by a single daemon
+# thread so no request waits on an audit commit. The thread is started lazily
+# (and again after a fork) so gunicorn --preload workers each get their own writer.
+_audit_queue = queue.Queue()
+_audit_lock = threading.Lock()
+_audit_conn = None
+_audit_writer_pid = None
+
+def log_usage_async(rows):
+    """Queue key_usage_log rows for the background writer"""
+    global _audit_writer_pid, _audit_conn
+    if _audit_writer_pid != os.getpid():
+        with _audit_lock:
+            if _audit_writer_pid != os.getpid():
+                _audit_conn = None
+                threading.Thread(target=_audit_writer, name='audit-writer', daemon=True).start()
+                _audit_writer_pid = os.getpid()
+    for row in rows:
+        _audit_queue.put(row)
+
+def _drain_audit_queue(rows, limit):
+    while len(rows) < limit:
+        try:
+            rows.append(_audit_queue.get_nowait())
+        except queue.Empty:
+            break
+    return rows
+
+def _write_usage_rows(rows):
+    global _audit_conn
+    if not rows:
+        return
+    with _audit_lock:
+        try:
+            if _audit_conn is None:
+                _audit_conn = connect_db()
+            with write_transaction(_audit_conn) as cursor:
+                cursor.executemany(SQL_INSERT_LOG, rows)
+        except sqlite3.Error as e:
+            print(f"❌ Failed to write {len(rows)} audit log rows: {e}")
+    for _ in rows:
+        _audit_queue.task_done()
+
+def flush_usage_log():
+    """Write every queued audit row and wait for any batch the writer is holding"""
+    while True:
+        rows = _drain_audit_queue([], AUDIT_BATCH_SIZE)
+        if not rows:
+            break
+        _write_usage_rows(rows)
+    _audit_queue.join()
+
+def _audit_writer():
+    while True:
+        rows = [_audit_queue.get()]  # sleep until there is work
+        time.sleep(AUDIT_FLUSH_INTERVAL)  # let a burst of requests land in one transaction
+        _write_usage_rows(_drain_audit_queue(rows, AUDIT_BATCH_SIZE))
+
+atexit.register(flush_usage_log)
+
+# --- Database maintenance ---
+# Like the audit writer, started lazily in each worker (and again after a fork)
+# so no SQLite handle or in-flight statement is ever inherited across fork.
+_maintenance_lock = threading.Lock()
+_maintenance_pid = None
+
+@app.before_request
+def start_db_maintenance():
+    global _maintenance_pid
+    if _maintenance_pid != os.getpid():
+        with _maintenance_lock:
+            if _maintenance_pid != os.getpid():
+                threading.Thread(target=_db_maintenance, name='db-maintenance', daemon=True).start()
+                _maintenance_pid = os.getpid()
+
+def _expire_stale_keys():
+    """Persist expiry for lapsed active keys on a short-lived connection"""
+    now = int(time.time())
+    with closing(connect_db()) as conn:
+        # Every worker sweeps; only the first to find stale keys takes the write lock
+        if conn.execute(SQL_HAS_STALE_KEYS, (now,)).fetchone() is None:
+            return
+        with write_transaction(conn) as cursor:
+            cursor.execute(SQL_EXPIRE_STALE_KEYS, (now,))
+
+def _db_maintenance():
+    """Expire stale keys every minute, truncate the WAL hourly and refresh planner statistics daily"""
+    with closing(connect_db()) as conn:
+        last_checkpoint = last_optimize = time.monotonic()
+        while True:
+            time.sleep(EXPIRY_SWEEP_INTERVAL)
+            try:
+                _expire_stale_keys()
+                if time.monotonic() - last_checkpoint >= WAL_CHECKPOINT_INTERVAL:
+                    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+                    last_checkpoint = time.monotonic()
+                if time.monotonic() - last_optimize >= OPTIMIZE_INTERVAL:
+                    conn.execute('PRAGMA optimize')
+                    last_optimize = time.monotonic()
+            except sqlite3.Error as e:
+                print(f"⚠️  Database maintenance failed: {e}")
+
+def migrate_schema(cursor):
+    """Bring a qkd_keys table created by an older release up to the current schema"""
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(qkd_keys)')}
+    if 'expires_at_epoch' not in columns:
+        cursor.execute('ALTER TABLE qkd_keys ADD COLUMN expires_at_epoch INTEGER')
+        rows = cursor.execute('SELECT key_id, expires_at FROM qkd_keys').fetchall()
+        cursor.executemany('UPDATE qkd_keys SET expires_at_epoch=? WHERE key_id=?', [
+            (int(datetime.datetime.fromisoformat(expires_at.replace('Z', '+00:00')).timestamp()), key_id)
+            for key_id, expires_at in rows
+        ])
+    if 'key_b64' in columns:
+        cursor.execute('ALTER TABLE qkd_keys ADD COLUMN key_bytes BLOB')
+        rows = cursor.execute('SELECT key_id, key_b64 FROM qkd_keys').fetchall()
+        cursor.executemany('UPDATE qkd_keys SET key_bytes=? WHERE key_id=?',
+                           [(base64.b64decode(key_b64), key_id) for key_id, key_b64 in rows])
+        if sqlite3.sqlite_version_info >= (3, 35, 0):
+            cursor.execute('ALTER TABLE qkd_keys DROP COLUMN key_b64')
+        else:
+            # No DROP COLUMN before SQLite 3.35: rebuild the table without key_b64
+            cursor.execute(SQL_CREATE_KEYS_TABLE.format(table='qkd_keys_new'))
+            cursor.execute(f'INSERT INTO qkd_keys_new ({KEY_COLUMNS}) SELECT {KEY_COLUMNS} FROM qkd_keys')
+            cursor.execute('DROP TABLE qkd_keys')
+            cursor.execute('ALTER TABLE qkd_keys_new RENAME TO qkd_keys')
+        print(f"🔄 Migrated {len(rows)} keys to raw BLOB storage")
+
 def init_database():
     os.makedirs('backend', exist_ok=True)
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS qkd_keys (
-                key_id TEXT PRIMARY KEY,
-                key_b64 TEXT NOT NULL,
-                sender TEXT NOT NULL,
-                recipient TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                expires_at TEXT NOT NULL,
-                status TEXT DEFAULT 'active',
-                algorithm TEXT DEFAULT 'AES-256-GCM',
-                key_length INTEGER DEFAULT 256
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS key_usage_log (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                key_id TEXT NOT NULL,
-                action TEXT NOT NULL,
-                timestamp TEXT NOT NULL,
-                details TEXT,
-                FOREIGN KEY (key_id) REFERENCES qkd_keys (key_id)
-            )
-        ''')
-        conn.commit()
+    # Closed explicitly: under gunicorn --preload this runs in the master before forking
+    with closing(connect_db()) as conn:
+        journal_mode = conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+        if journal_mode.lower() != 'wal':
+            print(f"⚠️  SQLite WAL mode unavailable, using journal_mode={journal_mode}")
+        # Off for this connection only, so a legacy table rebuild can drop qkd_keys under key_usage_log
+        conn.execute('PRAGMA foreign_keys=OFF')
+        with write_transaction(conn) as cursor:
+            cursor.execute(SQL_CREATE_KEYS_TABLE.format(table='qkd_keys'))
+            migrate_schema(cursor)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS key_usage_log (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    key_id TEXT NOT NULL,
+                    action TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    details TEXT,
+                    FOREIGN KEY (key_id) REFERENCES qkd_keys (key_id)
+                )
+            ''')
+            # /api/keys lists newest keys first; lets SQLite walk the index and stop at LIMIT
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_qkd_keys_created_at ON qkd_keys (created_at DESC)')
+            # One index per leg of SQL_LIST_USER_KEYS
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_qkd_keys_sender ON qkd_keys (sender, created_at DESC)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_qkd_keys_recipient ON qkd_keys (recipient, created_at DESC)')
+            # Partial index so the stale-key sweep only walks keys that are still active
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_qkd_keys_active_expiry ON qkd_keys (expires_at_epoch) WHERE status = 'active'")
+            # Audit lookups by key, and lets foreign-key checks avoid scanning the log
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_key_usage_log_key_id ON key_usage_log (key_id)')
+        # Sampled statistics keep startup fast on large databases
+        conn.execute('PRAGMA analysis_limit=400')
+        conn.execute('ANALYZE')
         print("✅ Database initialized successfully")
 
 # --- QKD Key Manager ---
 class QKDKeyManager:
-    def generate_key_id(self):
-        return f"qkd_{secrets.token_hex(16)}"
+    def __init__(self):
+        # Active keys never change until they expire, so a hit only needs a clock check
+        self._key_cache = OrderedDict()  # key_id -> (expires_at_epoch, key_data)
+        self._key_cache_lock = threading.Lock()
 
-    def generate_quantum_key(self, length=32):
-        """Generate cryptographically secure random key (32 bytes = 256-bit)"""
-        return get_random_bytes(length)
+    def generate_key_material(self, length=32, count=1):
+        """Draw (key_id, key_bytes) pairs for `count` keys from a single getrandom() call"""
+        stride = 16 + length
+        rnd = os.urandom(stride * count)
+        return [(f"qkd_{rnd[i:i + 16].hex()}", rnd[i + 16:i + stride]) for i in range(0, stride * count, stride)]
 
-    def request_key(self, sender, recipient, lifetime=3600):
-        key_id = self.generate_key_id()
-        key_bytes = self.generate_quantum_key(32)
-        key_b64 = base64.b64encode(key_bytes).decode('utf-8')
+    def request_keys(self, key_requests):
+        """Generate keys for several (sender, recipient, lifetime, algorithm) requests in one transaction"""
+        material = self.generate_key_material(32, len(key_requests))
 
-        created_at = datetime.datetime.utcnow().isoformat() + 'Z'
-        expires_at = (datetime.datetime.utcnow() + datetime.timedelta(seconds=lifetime)).isoformat() + 'Z'
+        # Expiry is checked against integer epoch seconds; the ISO strings are for display only
+        now, created_at = request_time()
+        rows = []
+        for (key_id, key_bytes), (sender, recipient, lifetime, algorithm) in zip(material, key_requests):
+            expires_at_epoch = int(now + lifetime)
+            expires_at = datetime.datetime.fromtimestamp(expires_at_epoch, datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
+            rows.append((key_id, key_bytes, sender, recipient, created_at, expires_at, expires_at_epoch, algorithm))
 
-        with sqlite3.connect(DATABASE) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO qkd_keys (key_id, key_b64, sender, recipient, created_at, expires_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (key_id, key_b64, sender, recipient, created_at, expires_at))
+        with write_transaction(get_db()) as cursor:
+            cursor.executemany(SQL_INSERT_KEY, rows)
+        # Logged after the keys commit, so audit rows never reference a missing key
+        log_usage_async([(row[0], 'KEY_GENERATED', created_at, f"{row[2]} -> {row[3]}") for row in rows])
 
-            cursor.execute('''
-                INSERT INTO key_usage_log (key_id, action, timestamp, details)
-                VALUES (?, ?, ?, ?)
-            ''', (key_id, 'KEY_GENERATED', created_at, f"{sender} -> {recipient}"))
-            conn.commit()
-
-        print(f"🔑 Generated key {key_id} for {sender} -> {recipient}")
-        return {
-            'key_id': key_id,
-            'key_b64': key_b64,
-            'expires_at': expires_at,
-            'algorithm': 'AES-256-GCM',
-            'status': 'active'
-        }
+        keys = []
+        for key_id, key_bytes, sender, recipient, _, expires_at, _, algorithm in rows:
+            print(f"🔑 Generated key {key_id} for {sender} -> {recipient}")
+            keys.append({
+                'key_id': key_id,
+                'key_b64': b2a_base64(key_bytes, newline=False).decode('ascii'),
+                'expires_at': expires_at,
+                'algorithm': algorithm,
+                'status': 'active'
+            })
+        return keys
 
-    def get_key(self, key_id):
-        with sqlite3.connect(DATABASE) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT key_id, key_b64, sender, recipient, created_at, expires_at, status, algorithm
-                FROM qkd_keys WHERE key_id = ?
-            ''', (key_id,))
-            row = cursor.fetchone()
-            if not row:
-                return None
+    def request_key(self, sender, recipient, lifetime=3600, algorithm=KEY_ALGORITHMS[0]):
+        return self.request_keys([(sender, recipient, lifetime, algorithm)])[0]
+
+    def get_keys(self, key_ids):
+        """Fetch several keys, querying only cache misses; returns {key_id: key_data} for the keys that exist"""
+        key_ids = list(dict.fromkeys(key_ids))
+        if not key_ids:
+            return {}
 
+        now, accessed_at = request_time()
+        found = {}
+        misses = []
+        with self._key_cache_lock:
+            for key_id in key_ids:
+                entry = self._key_cache.get(key_id)
+                if entry is not None and now <= entry[0]:
+                    self._key_cache.move_to_end(key_id)
+                    found[key_id] = dict(entry[1])
+                else:
+                    # Lapsed entries fall through to the query so the expiry gets persisted
+                    self._key_cache.pop(key_id, None)
+                    misses.append(key_id)
+
+        newly_expired = []
+        to_cache = []
+        rows = []
+        if misses:
+            cursor = get_db().cursor()
+            cursor.execute(SQL_SELECT_KEYS.format(placeholders=','.join('?' * len(misses))), misses)
+            rows = cursor.fetchall()
+        for row in rows:
             key_data = {
                 'key_id': row[0],
-                'key_b64': row[1],
+                'key_bytes': row[1],
                 'sender': row[2],
                 'recipient': row[3],
                 'created_at': row[4],
@@ -120,36 +446,80 @@ class QKDKeyManager:
             }
 
             # Check expiration
-            expires_at = datetime.datetime.fromisoformat(row[5].replace('Z', '+00:00'))
-            if datetime.datetime.utcnow().replace(tzinfo=expires_at.tzinfo) > expires_at:
-                cursor.execute('UPDATE qkd_keys SET status="expired" WHERE key_id=?', (key_id,))
-                conn.commit()
+            if now > row[8]:
+                if key_data['status'] != 'expired':
+                    newly_expired.append((row[0],))
                 key_data['status'] = 'expired'
+            elif key_data['status'] == 'active':
+                to_cache.append((row[0], (row[8], dict(key_data))))
+            found[row[0]] = key_data
 
-            # Log access
-            cursor.execute('''
-                INSERT INTO key_usage_log (key_id, action, timestamp, details)
-                VALUES (?, ?, ?, ?)
-            ''', (key_id, 'KEY_ACCESSED', datetime.datetime.utcnow().isoformat()+'Z', 'Key retrieved for decryption'))
-            conn.commit()
+        if to_cache:
+            with self._key_cache_lock:
+                self._key_cache.update(to_cache)
+                while len(self._key_cache) > KEY_CACHE_SIZE:
+                    self._key_cache.popitem(last=False)
+
+        # Only take the write lock when a key actually changed state
+        if newly_expired:
+            with write_transaction(get_db()) as cursor:
+                cursor.executemany(SQL_EXPIRE_KEY, newly_expired)
+
+        # Access logs are written by the background audit writer, off the request path
+        log_usage_async([
+            (key_id, 'KEY_ACCESSED', accessed_at, 'Key retrieved for decryption') for key_id in found
+        ])
 
+        for key_id, key_data in found.items():
             print(f"🔍 Retrieved key {key_id} (status: {key_data['status']})")
-            return key_data
+        return found
+
+    def get_key(self, key_id):
+        return self.get_keys([key_id]).get(key_id)
 
 key_manager = QKDKeyManager()
 
 # --- API ROUTES ---
+def valid_key_request(sender, recipient, lifetime, algorithm):
+    """Check the fields of one key request before anything reaches the database"""
+    return (isinstance(sender, str) and sender and isinstance(recipient, str) and recipient
+            and isinstance(lifetime, int) and not isinstance(lifetime, bool)
+            and 0 < lifetime <= MAX_KEY_LIFETIME and algorithm in KEY_ALGORITHMS)
+
+KEY_REQUEST_ERROR = (f'sender and recipient required, lifetime must be 1-{MAX_KEY_LIFETIME} seconds, '
+                     f'algorithm one of {", ".join(KEY_ALGORITHMS)}')
+
 @app.route('/api/request_key', methods=['POST'])
 def api_request_key():
     data = request.get_json()
     sender = data.get('sender')
     recipient = data.get('recipient')
     lifetime = data.get('lifetime', 3600)
-    if not sender or not recipient:
-        return jsonify({'error': 'sender and recipient required'}), 400
-    key_data = key_manager.request_key(sender, recipient, lifetime)
+    algorithm = data.get('algorithm', KEY_ALGORITHMS[0])
+    if not valid_key_request(sender, recipient, lifetime, algorithm):
+        return jsonify({'error': KEY_REQUEST_ERROR}), 400
+    key_data = key_manager.request_key(sender, recipient, lifetime, algorithm)
     return jsonify({'status': 'success', **key_data})
 
+@app.route('/api/request_keys', methods=['POST'])
+def api_request_keys():
+    data = request.get_json()
+    key_requests = data.get('requests')
+    if not isinstance(key_requests, list) or not key_requests:
+        return jsonify({'error': 'requests list required'}), 400
+    if len(key_requests) > MAX_BATCH_KEYS:
+        return jsonify({'error': f'at most {MAX_BATCH_KEYS} requests per call'}), 400
+    if not all(isinstance(r, dict) and valid_key_request(r.get('sender'), r.get('recipient'), r.get('lifetime', 3600),
+                                                         r.get('algorithm', KEY_ALGORITHMS[0]))
+               for r in key_requests):
+        return jsonify({'error': f'{KEY_REQUEST_ERROR} (every request)'}), 400
+
+    keys = key_manager.request_keys([
+        (r['sender'], r['recipient'], r.get('lifetime', 3600), r.get('algorithm', KEY_ALGORITHMS[0]))
+        for r in key_requests
+    ])
+    return jsonify({'status': 'success', 'keys': keys, 'count': len(keys)})
+
 @app.route('/api/get_key/<key_id>', methods=['GET'])
 def api_get_key(key_id):
     key_data = key_manager.get_key(key_id)
@@ -157,41 +527,76 @@ def api_get_key(key_id):
         return jsonify({'error': 'Key not found'}), 404
     if key_data['status'] == 'expired':
         return jsonify({'error': 'Key has expired'}), 410
-    return jsonify({'status': 'success', 'key_data': key_data})
+    # Keys are stored as raw bytes; base64 only at the JSON boundary
+    key_bytes = key_data.pop('key_bytes')
+    key_data['key_b64'] = b2a_base64(key_bytes, newline=False).decode('ascii')
+    response = jsonify({'status': 'success', 'key_data': key_data})
+    # Raw key material: clients keep their own expiry-bounded copy, nothing in between may store it
+    response.cache_control.no_store = True
+    return response
+
+@app.route('/api/get_keys', methods=['POST'])
+def api_get_keys():
+    data = request.get_json()
+    key_ids = data.get('key_ids')
+    if not isinstance(key_ids, list) or not key_ids or not all(isinstance(k, str) for k in key_ids):
+        return jsonify({'error': 'key_ids list required'}), 400
+    if len(key_ids) > MAX_BATCH_KEYS:
+        return jsonify({'error': f'at most {MAX_BATCH_KEYS} key_ids per request'}), 400
+
+    found = key_manager.get_keys(key_ids)
+    keys, expired = {}, []
+    for key_id, key_data in found.items():
+        if key_data['status'] == 'expired':
+            expired.append(key_id)
+            continue
+        key_data['key_b64'] = b2a_base64(key_data.pop('key_bytes'), newline=False).decode('ascii')
+        keys[key_id] = key_data
+    missing = [key_id for key_id in dict.fromkeys(key_ids) if key_id not in found]
+    return jsonify({'status': 'success', 'key_data': keys, 'expired': expired, 'missing': missing})
 
 @app.route('/api/keys', methods=['GET'])
 def api_list_keys():
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT key_id, sender, recipient, created_at, expires_at, status, algorithm
-            FROM qkd_keys ORDER BY created_at DESC LIMIT 50
-        ''')
-        keys = []
-        for row in cursor.fetchall():
-            keys.append({
-                'key_id': row[0],
-                'sender': row[1],
-                'recipient': row[2],
-                'created_at': row[3],
-                'expires_at': row[4],
-                'status': row[5],
-                'algorithm': row[6]
-            })
-    return jsonify({'status': 'success', 'keys': keys, 'count': len(keys)})
+    user = request.args.get('user')
+    now = request_time()[0]
+    cursor = get_db().cursor()
+    if user:
+        cursor.execute(SQL_LIST_USER_KEYS, (user, user, user))
+    else:
+        cursor.execute(SQL_LIST_KEYS)
+    keys = []
+    for row in cursor.fetchall():
+        # The maintenance thread persists expiry in bulk; report lapsed keys as expired meanwhile
+        status = 'expired' if row[5] == 'active' and now > row[7] else row[5]
+        keys.append({
+            'key_id': row[0],
+            'sender': row[1],
+            'recipient': row[2],
+            'created_at': row[3],
+            'expires_at': row[4],
+            'status': status,
+            'algorithm': row[6]
+        })
+    response = jsonify({'status': 'success', 'keys': keys, 'count': len(keys)})
+    # Pollers that already hold this exact listing get a bodiless 304
+    response.add_etag()
+    return response.make_conditional(request)
+
+# Everything but the timestamp is constant, so serialize it once at import
+_HEALTH_PREFIX = orjson.dumps({
+    'status': 'healthy',
+    'service': 'QuMail QKD Key Manager',
+    'version': '1.0.0',
+    'port': API_PORT
+})[:-1] + b',"timestamp":"'
 
 @app.route('/api/health', methods=['GET'])
 def api_health():
-    return jsonify({
-        'status': 'healthy',
-        'service': 'QuMail QKD Key Manager',
-        'version': '1.0.0',
-        'port': API_PORT,
-        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z'
-    })
+    body = _HEALTH_PREFIX + request_time()[1].encode('ascii') + b'"}'
+    return app.response_class(body, mimetype='application/json')
 
 # --- MAIN ---
 if __name__ == '__main__':
     init_database()
     print(f"🚀 QuMail QKD Key Manager running on http://localhost:{API_PORT}")
-    app.run(debug=True, host='0.0.0.0', port=API_PORT)
+    app.run(debug=os.getenv('FLASK_DEBUG') == '1', host='0.0.0.0', port=API_PORT)
@@ -0,0 +1,11 @@
+"""
+WSGI entry point for running the QKD Key Manager under a production server.
+
+Usage:
+gunicorn --preload --pythonpath backend -k gthread --threads 4 -b 0.0.0.0:5001 wsgi:app
+"""
+
+from app import app, init_database
+
+# --preload runs this once in the gunicorn master before workers fork
+init_database()
@@ -12,20 +12,38 @@ Configuration:
     Set IMAP credentials in config.json or environment variables
 """
 
-import imaplib
 import email
-import requests
+import email.policy
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 import json
+import orjson
 import base64
+import binascii
+try:
+    from pybase64 import b64decode as _b64decode  # SIMD base64 for large bodies
+except ImportError:
+    _b64decode = binascii.a2b_base64
 from email.header import decode_header
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from functools import lru_cache
 import os
 import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
 
 # Configuration
 CONFIG_FILE = 'config.json'
 QKD_API_BASE = 'http://localhost:5000/api/qkd'
+AEAD_CIPHERS = {'AES-256-GCM': 'AESGCM', 'ChaCha20-Poly1305': 'ChaCha20Poly1305'}  # cryptography aead class names
+STREAM_THRESHOLD = 1024 * 1024  # AES-GCM bodies at least this large are decrypted in chunks
+STREAM_CHUNK_SIZE = 64 * 1024
+KEY_CACHE_SIZE = 512
+BODY_PREVIEW_BYTES = 4096  # enough for display_email's 500-character preview in any UTF-8
+KEY_FETCH_WORKERS = 8  # concurrent key lookups when decrypting a whole inbox
+ENCRYPTED_DATA_RE = re.compile(r'--- ENCRYPTED MESSAGE DATA ---\s*\n(.*?)\n--- END ENCRYPTED DATA ---', re.DOTALL)
 
 def load_config():
     """Load IMAP configuration"""
@@ -46,13 +64,61 @@ def load_config():
     
     return config
 
+# Lazy keep-alive session, as in recv_email.py, sized for the prefetch threads
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """Return the shared Key Manager session, creating it on first use"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            _session = requests.Session()
+            _session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=KEY_FETCH_WORKERS))
+        return _session
+
+# Expiry-bounded key cache mirrored from recv_email.py
+_key_cache = OrderedDict()  # key_id -> (expires_epoch, key_b64)
+_key_cache_lock = threading.Lock()
+
+def _cached_key(key_id):
+    """Return a still-valid cached key, or None"""
+    with _key_cache_lock:
+        entry = _key_cache.get(key_id)
+        if entry is None:
+            return None
+        if time.time() > entry[0]:
+            del _key_cache[key_id]
+            return None
+        _key_cache.move_to_end(key_id)
+        return entry[1]
+
+def _cache_key(key_id, key_data):
+    """Remember a fetched key until the expiry the Key Manager reported"""
+    expires_at = key_data.get('expires_at')
+    if not expires_at:
+        return
+    expires_epoch = datetime.fromisoformat(expires_at.replace('Z', '+00:00')).timestamp()
+    with _key_cache_lock:
+        _key_cache[key_id] = (expires_epoch, key_data['key_b64'])
+        _key_cache.move_to_end(key_id)
+        while len(_key_cache) > KEY_CACHE_SIZE:
+            _key_cache.popitem(last=False)
+
 def get_qkd_key(key_id):
     """Retrieve QKD key from Key Manager"""
+    key_b64 = _cached_key(key_id)
+    if key_b64:
+        return key_b64
+    import requests
     try:
-        response = requests.get(f'{QKD_API_BASE}/get_key/{key_id}', timeout=10)
+        response = get_session().get(f'{QKD_API_BASE}/get_key/{key_id}', timeout=10)
         
         if response.status_code == 200:
             data = response.json()
+            _cache_key(key_id, data['key_data'])
             return data['key_data']['key_b64']
         elif response.status_code == 404:
             raise Exception("QKD key not found")
@@ -64,19 +130,58 @@ def get_qkd_key(key_id):
     except requests.RequestException as e:
         raise Exception(f"Failed to connect to QKD Key Manager: {e}")
 
-def decrypt_message(ciphertext_b64, nonce_b64, key_b64):
-    """Decrypt message using AES-256-GCM"""
-    key = base64.b64decode(key_b64)
-    ciphertext = base64.b64decode(ciphertext_b64)
-    nonce = base64.b64decode(nonce_b64)
+def prefetch_qkd_keys(key_ids):
+    """Retrieve several QKD keys concurrently; returns {key_id: key_b64} for the ones that succeeded"""
+    def fetch(key_id):
+        try:
+            return key_id, get_qkd_key(key_id)
+        except Exception:
+            return key_id, None  # decrypt_qumail_email retries and reports the error
     
-    aesgcm = AESGCM(key)
-    plaintext = aesgcm.decrypt(nonce, ciphertext, None)
+    key_ids = list(dict.fromkeys(key_ids))
+    with ThreadPoolExecutor(max_workers=KEY_FETCH_WORKERS) as executor:
+        return {key_id: key_b64 for key_id, key_b64 in executor.map(fetch, key_ids) if key_b64}
+
+@lru_cache(maxsize=1024)
+def _aead_for(key_b64, algorithm):
+    """Return a cached AEAD instance so the key schedule is expanded once per key"""
+    if algorithm not in AEAD_CIPHERS:
+        raise Exception(f"Unsupported algorithm: {algorithm}")
+    from cryptography.hazmat.primitives.ciphers import aead
+    return getattr(aead, AEAD_CIPHERS[algorithm])(base64.b64decode(key_b64))
+
+def _aesgcm_decrypt_chunked(key, nonce, data):
+    """AES-GCM decrypt ciphertext||tag in cache-sized chunks into one plaintext buffer"""
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    src, tag = memoryview(data)[:-16], bytes(data[-16:])
+    decryptor = Cipher(algorithms.AES(key), modes.GCM(nonce, tag)).decryptor()
+    out = bytearray(len(src) + 15)
+    dst = memoryview(out)
+    pos = 0
+    for start in range(0, len(src), STREAM_CHUNK_SIZE):
+        pos += decryptor.update_into(src[start:start + STREAM_CHUNK_SIZE], dst[pos:])
+    decryptor.finalize()  # raises InvalidTag if the message was tampered with
+    dst.release()
+    del out[pos:]
+    return out
+
+def decrypt_message(ciphertext_b64, nonce_b64, key_b64, algorithm='AES-256-GCM'):
+    """Decrypt message using the AEAD named in the payload (AES-256-GCM by default)"""
+    ciphertext = _b64decode(ciphertext_b64)
+    nonce = _b64decode(nonce_b64)
+    
+    if algorithm == 'AES-256-GCM' and len(ciphertext) >= STREAM_THRESHOLD:
+        plaintext = _aesgcm_decrypt_chunked(base64.b64decode(key_b64), nonce, ciphertext)
+    else:
+        plaintext = _aead_for(key_b64, algorithm).decrypt(nonce, ciphertext, None)
     
     return plaintext.decode('utf-8')
 
 def decode_email_header(header):
     """Decode email header"""
+    # Plain ASCII without RFC 2047 encoded words needs no decoding
+    if isinstance(header, str) and header.isascii() and '=?' not in header:
+        return header
     decoded_header = decode_header(header)
     return ''.join([
         text.decode(encoding or 'utf-8') if isinstance(text, bytes) else text
@@ -85,24 +190,55 @@ def decode_email_header(header):
 
 def extract_encrypted_data(email_body):
     """Extract encrypted data from email body"""
-    # Look for encrypted message data block
-    pattern = r'--- ENCRYPTED MESSAGE DATA ---\s*\n(.*?)\n--- END ENCRYPTED DATA ---'
-    match = re.search(pattern, email_body, re.DOTALL)
+    match = ENCRYPTED_DATA_RE.search(email_body)
     
     if not match:
         return None
     
     try:
-        encrypted_data = json.loads(match.group(1))
+        encrypted_data = orjson.loads(match.group(1))
         return encrypted_data
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         return None
 
+@lru_cache(maxsize=None)
+def _tls_context():
+    """Same verifying TLS context as send_email.py; the scripts are standalone"""
+    import ssl
+    context = ssl.create_default_context()
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    return context
+
+# IMAP batching helpers mirrored from recv_email.py
+def imap_sequence_set(message_ids):
+    """Collapse message numbers into an IMAP sequence set, e.g. [3, 5, 6, 7] -> '3,5:7'"""
+    numbers = sorted(int(msg_id) for msg_id in message_ids)
+    ranges = []
+    start = end = numbers[0]
+    for number in numbers[1:]:
+        if number == end + 1:
+            end = number
+            continue
+        ranges.append(f"{start}:{end}" if end > start else str(start))
+        start = end = number
+    ranges.append(f"{start}:{end}" if end > start else str(start))
+    return ','.join(ranges)
+
+def fetch_messages(imap, message_ids, parts='(BODY.PEEK[])'):
+    """Fetch several messages in one round trip; returns {msg_id: raw message bytes}"""
+    if not message_ids:
+        return {}
+    status, data = imap.fetch(imap_sequence_set(message_ids), parts)
+    if status != 'OK':
+        return {}
+    return {item[0].split(None, 1)[0]: item[1] for item in data if isinstance(item, tuple)}
+
 def fetch_emails(config, mailbox='INBOX'):
     """Fetch emails from IMAP server"""
+    import imaplib
     try:
         # Connect to IMAP server
-        with imaplib.IMAP4_SSL(config['imap_server'], config['imap_port']) as imap:
+        with imaplib.IMAP4_SSL(config['imap_server'], config['imap_port'], ssl_context=_tls_context()) as imap:
             imap.login(config['imap_username'], config['imap_password'])
             imap.select(mailbox)
             
@@ -114,13 +250,14 @@ def fetch_emails(config, mailbox='INBOX'):
             message_ids = messages[0].split()[-10:]  # Get last 10 emails
             
             emails = []
+            raw_messages = fetch_messages(imap, message_ids)
             for msg_id in message_ids:
-                status, msg_data = imap.fetch(msg_id, '(RFC822)')
-                if status != 'OK':
+                raw_message = raw_messages.get(msg_id)
+                if raw_message is None:
                     continue
                 
                 # Parse email
-                email_message = email.message_from_bytes(msg_data[0][1])
+                email_message = email.message_from_bytes(raw_message, policy=email.policy.default)
                 
                 # Extract headers
                 subject = decode_email_header(email_message.get('Subject', ''))
@@ -133,14 +270,18 @@ def fetch_emails(config, mailbox='INBOX'):
                 algorithm = email_message.get('X-QuMail-Algorithm')
                 
                 # Extract body
-                body = ""
+                payload = b""
                 if email_message.is_multipart():
-                    for part in email_message.walk():
-                        if part.get_content_type() == "text/plain":
-                            body = part.get_payload(decode=True).decode('utf-8')
-                            break
+                    part = email_message.get_body(preferencelist=('plain',))
+                    if part is not None:
+                        payload = part.get_payload(decode=True)
                 else:
-                    body = email_message.get_payload(decode=True).decode('utf-8')
+                    payload = email_message.get_payload(decode=True) or b""
+                if is_qumail:
+                    body = payload.decode('utf-8')
+                else:
+                    # Standard mail is only shown as a 500-character preview; decode just its head
+                    body = payload[:BODY_PREVIEW_BYTES].decode('utf-8', errors='ignore')
                 
                 emails.append({
                     'id': msg_id.decode(),
@@ -159,8 +300,8 @@ def fetch_emails(config, mailbox='INBOX'):
     except Exception as e:
         raise Exception(f"Failed to fetch emails: {e}")
 
-def decrypt_qumail_email(email_data):
-    """Decrypt QuMail encrypted email"""
+def decrypt_qumail_email(email_data, key_cache=None):
+    """Decrypt QuMail encrypted email, using key_cache ({key_id: key_b64}) before the Key Manager"""
     if not email_data['is_qumail']:
         return email_data
     
@@ -175,14 +316,16 @@ def decrypt_qumail_email(email_data):
         
         # Get QKD key
         print("🔍 Retrieving QKD key...")
-        key_b64 = get_qkd_key(email_data['key_id'])
+        key_b64 = (key_cache or {}).get(email_data['key_id']) or get_qkd_key(email_data['key_id'])
         
         # Decrypt message
-        print("🔓 Decrypting with AES-256-GCM...")
+        algorithm = encrypted_data.get('algorithm', 'AES-256-GCM')
+        print(f"🔓 Decrypting with {algorithm}...")
         decrypted_body = decrypt_message(
             encrypted_data['ciphertext'],
             encrypted_data['nonce'],
-            key_b64
+            key_b64,
+            algorithm
         )
         
         # Update email data
@@ -200,28 +343,32 @@ def decrypt_qumail_email(email_data):
 
 def display_email(email_data):
     """Display email in formatted output"""
-    print("\n" + "="*60)
-    print(f"📧 Subject: {email_data['subject']}")
-    print(f"👤 From: {email_data['from']}")
-    print(f"📅 Date: {email_data['date']}")
+    # Build the whole entry and write it once instead of one print per line
+    lines = []
+    out = lines.append
+    out("\n" + "="*60)
+    out(f"📧 Subject: {email_data['subject']}")
+    out(f"👤 From: {email_data['from']}")
+    out(f"📅 Date: {email_data['date']}")
     
     if email_data['is_qumail']:
         if email_data['decrypted']:
-            print("🔓 Status: QuMail Encrypted (Decrypted)")
-            print(f"🔑 Key ID: {email_data['key_id']}")
-            print(f"🛡️  Algorithm: {email_data['algorithm']}")
+            out("🔓 Status: QuMail Encrypted (Decrypted)")
+            out(f"🔑 Key ID: {email_data['key_id']}")
+            out(f"🛡️  Algorithm: {email_data['algorithm']}")
         elif email_data.get('decrypt_error'):
-            print("❌ Status: QuMail Encrypted (Decryption Failed)")
-            print(f"💥 Error: {email_data['decrypt_error']}")
+            out("❌ Status: QuMail Encrypted (Decryption Failed)")
+            out(f"💥 Error: {email_data['decrypt_error']}")
         else:
-            print("🔒 Status: QuMail Encrypted (Not Decrypted)")
+            out("🔒 Status: QuMail Encrypted (Not Decrypted)")
     else:
-        print("📝 Status: Standard Email")
+        out("📝 Status: Standard Email")
     
-    print("\n📄 Body:")
-    print("-" * 60)
-    print(email_data['body'][:500] + ('...' if len(email_data['body']) > 500 else ''))
-    print("="*60)
+    out("\n📄 Body:")
+    out("-" * 60)
+    out(email_data['body'][:500] + ('...' if len(email_data['body']) > 500 else ''))
+    out("="*60)
+    sys.stdout.write('\n'.join(lines) + '\n')
 
 def main():
     """Main function"""
@@ -253,9 +400,13 @@ def main():
             qumail_count = sum(1 for e in emails if e['is_qumail'])
             print(f"🔒 QuMail encrypted: {qumail_count}")
             
+            key_cache = {}
+            if args.decrypt:
+                key_cache = prefetch_qkd_keys(e['key_id'] for e in emails if e['is_qumail'] and e['key_id'])
+            
             for email_data in emails:
                 if args.decrypt and email_data['is_qumail']:
-                    email_data = decrypt_qumail_email(email_data)
+                    email_data = decrypt_qumail_email(email_data, key_cache)
                 
                 display_email(email_data)
                 
@@ -12,20 +12,50 @@ Configuration:
 """
 
 import smtplib
+import ssl
+import atexit
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import argparse
 import json
+import orjson
 import base64
+import binascii
+try:
+    from pybase64 import b64encode_as_string as _b64encode  # SIMD base64 for large bodies
+except ImportError:
+    def _b64encode(data):
+        return binascii.b2a_base64(data, newline=False).decode('ascii')
 from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from functools import lru_cache
 import secrets
 import os
-from datetime import datetime
+from datetime import datetime, timezone
 
 # Configuration
 CONFIG_FILE = 'config.json'
 QKD_API_BASE = 'http://localhost:5000/api/qkd'
+SMTPS_PORT = 465  # implicit-TLS submission port
+AEAD_CIPHERS = {'AES-256-GCM': AESGCM, 'ChaCha20-Poly1305': ChaCha20Poly1305}
+STREAM_THRESHOLD = 1024 * 1024  # AES-GCM bodies at least this large are encrypted in chunks
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def _cpu_has_aes():
+    """Best-effort check for hardware AES (x86 AES-NI or ARMv8 crypto extensions)"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith(('flags', 'Features')):
+                    return 'aes' in line.split()
+    except OSError:
+        pass
+    return True  # Can't tell (non-Linux): assume AES is accelerated
+
+# Software AES-GCM is much slower than ChaCha20-Poly1305, so only pick it with hardware AES
+DEFAULT_ALGORITHM = 'AES-256-GCM' if _cpu_has_aes() else 'ChaCha20-Poly1305'
 
 def load_config():
     """Load SMTP configuration"""
@@ -47,70 +77,129 @@ def load_config():
     
     return config
 
-def request_qkd_key(sender, recipient, lifetime=3600):
-    """Request QKD key from Key Manager"""
+# One keep-alive session for all Key Manager calls; only connection failures are retried
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(max_retries=Retry(total=2, connect=2, read=0, status=0, other=0, backoff_factor=0.05)))
+
+def request_qkd_key(sender, recipient, lifetime=3600, algorithm=DEFAULT_ALGORITHM):
+    """Request QKD key from Key Manager; returns (key_id, key_b64, algorithm recorded with the key)"""
     try:
-        response = requests.post(f'{QKD_API_BASE}/request_key', json={
+        response = SESSION.post(f'{QKD_API_BASE}/request_key', json={
             'sender': sender,
             'recipient': recipient,
-            'lifetime': lifetime
+            'lifetime': lifetime,
+            'algorithm': algorithm
         }, timeout=10)
         
         if response.status_code == 200:
             data = response.json()
-            return data['key_id'], data['key_b64']
+            return data['key_id'], data['key_b64'], data.get('algorithm', algorithm)
         else:
             raise Exception(f"QKD key request failed: {response.text}")
             
     except requests.RequestException as e:
         raise Exception(f"Failed to connect to QKD Key Manager: {e}")
 
-def encrypt_message(plaintext, key_b64):
-    """Encrypt message using AES-256-GCM"""
-    key = base64.b64decode(key_b64)
-    aesgcm = AESGCM(key)
-    nonce = secrets.token_bytes(12)  # 96-bit nonce for GCM
+@lru_cache(maxsize=1024)
+def _aead_for(key_b64, algorithm):
+    """Return a cached AEAD instance so the key schedule is expanded once per key"""
+    return AEAD_CIPHERS[algorithm](base64.b64decode(key_b64))
+
+def _aesgcm_encrypt_chunked(key, nonce, data):
+    """AES-GCM encrypt in cache-sized chunks straight into one ciphertext||tag buffer"""
+    encryptor = Cipher(algorithms.AES(key), modes.GCM(nonce)).encryptor()
+    out = bytearray(len(data) + 16)
+    src, dst = memoryview(data), memoryview(out)
+    pos = 0
+    for start in range(0, len(data), STREAM_CHUNK_SIZE):
+        pos += encryptor.update_into(src[start:start + STREAM_CHUNK_SIZE], dst[pos:])
+    encryptor.finalize()
+    out[pos:] = encryptor.tag
+    return out
+
+def encrypt_message(plaintext, key_b64, algorithm=DEFAULT_ALGORITHM):
+    """Encrypt message using AES-256-GCM or ChaCha20-Poly1305"""
+    nonce = secrets.token_bytes(12)  # 96-bit nonce for both AEADs
     
-    ciphertext = aesgcm.encrypt(nonce, plaintext.encode('utf-8'), None)
+    data = plaintext.encode('utf-8')
+    if algorithm == 'AES-256-GCM' and len(data) >= STREAM_THRESHOLD:
+        ciphertext = _aesgcm_encrypt_chunked(base64.b64decode(key_b64), nonce, data)
+    else:
+        ciphertext = _aead_for(key_b64, algorithm).encrypt(nonce, data, None)
     
     return {
-        'ciphertext': base64.b64encode(ciphertext).decode('utf-8'),
-        'nonce': base64.b64encode(nonce).decode('utf-8')
+        'algorithm': algorithm,
+        'ciphertext': _b64encode(ciphertext),
+        'nonce': _b64encode(nonce)
     }
 
+@lru_cache(maxsize=None)
+def _tls_context():
+    """Same verifying TLS context as send_email.py; the scripts are standalone"""
+    context = ssl.create_default_context()
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    return context
+
+_smtp_connections = {}
+
+def get_smtp_connection(config):
+    """Return an authenticated SMTP connection, reused across sends while the server keeps it open"""
+    conn_key = (config['smtp_server'], config['smtp_port'], config['smtp_username'])
+    server = _smtp_connections.pop(conn_key, None)
+    if server is not None:
+        try:
+            if server.noop()[0] == 250:
+                _smtp_connections[conn_key] = server
+                return server
+        except (smtplib.SMTPException, OSError):
+            pass
+        server.close()
+    
+    if config['smtp_port'] == SMTPS_PORT:
+        # Implicit TLS: the handshake starts on connect, no plaintext EHLO + STARTTLS round trip
+        server = smtplib.SMTP_SSL(config['smtp_server'], config['smtp_port'], context=_tls_context())
+    else:
+        server = smtplib.SMTP(config['smtp_server'], config['smtp_port'])
+    try:
+        if config['smtp_port'] != SMTPS_PORT:
+            server.starttls(context=_tls_context())
+        server.login(config['smtp_username'], config['smtp_password'])
+    except Exception:
+        server.close()
+        raise
+    _smtp_connections[conn_key] = server
+    return server
+
+@atexit.register
+def close_smtp_connections():
+    while _smtp_connections:
+        _, server = _smtp_connections.popitem()
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
 def send_encrypted_email(to_address, subject, body, config):
     """Send quantum-encrypted email via SMTP"""
     try:
         # Step 1: Request QKD key
         print(f"🔑 Requesting QKD key for {config['sender_email']} -> {to_address}")
-        key_id, key_b64 = request_qkd_key(config['sender_email'], to_address)
+        key_id, key_b64, algorithm = request_qkd_key(config['sender_email'], to_address)
         print(f"✅ QKD key obtained: {key_id}")
         
-        # Step 2: Encrypt message
-        print("🔐 Encrypting message with AES-256-GCM...")
-        encrypted = encrypt_message(body, key_b64)
-        
-        # Step 3: Prepare email
-        msg = MIMEMultipart()
-        msg['From'] = config['sender_email']
-        msg['To'] = to_address
-        msg['Subject'] = subject
+        # Step 2: Encrypt message with the algorithm the key is recorded under
+        print(f"🔐 Encrypting message with {algorithm}...")
+        encrypted = encrypt_message(body, key_b64, algorithm)
         
-        # Add custom headers for QuMail
-        msg['X-QuMail-Encrypted'] = 'true'
-        msg['X-QuMail-Key-ID'] = key_id
-        msg['X-QuMail-Algorithm'] = 'AES-256-GCM'
-        msg['X-QuMail-Version'] = '1.0'
-        
-        # Create encrypted body with metadata
-        encrypted_body = json.dumps({
+        # Step 3: Prepare email, starting with the encrypted body and metadata
+        encrypted_body = orjson.dumps({
             'version': '1.0',
-            'algorithm': 'AES-256-GCM',
+            'algorithm': encrypted['algorithm'],
             'key_id': key_id,
             'ciphertext': encrypted['ciphertext'],
             'nonce': encrypted['nonce'],
-            'timestamp': datetime.utcnow().isoformat() + 'Z'
-        }, indent=2)
+            'timestamp': datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+        }).decode('utf-8')
         
         # Add plaintext notice for non-QuMail clients
         plaintext_notice = f"""
@@ -127,19 +216,26 @@ To decrypt this message, you need:
 QuMail - Quantum-Secure Email Communication
         """.strip()
         
-        msg.attach(MIMEText(plaintext_notice, 'plain'))
+        # Single text part; a multipart wrapper adds nothing without attachments
+        msg = MIMEText(plaintext_notice, 'plain')
+        msg['From'] = config['sender_email']
+        msg['To'] = to_address
+        msg['Subject'] = subject
+        
+        # Add custom headers for QuMail
+        msg['X-QuMail-Encrypted'] = 'true'
+        msg['X-QuMail-Key-ID'] = key_id
+        msg['X-QuMail-Algorithm'] = encrypted['algorithm']
+        msg['X-QuMail-Version'] = '1.0'
         
         # Step 4: Send email
         print(f"📧 Sending encrypted email to {to_address}...")
         
-        with smtplib.SMTP(config['smtp_server'], config['smtp_port']) as server:
-            server.starttls()
-            server.login(config['smtp_username'], config['smtp_password'])
-            server.send_message(msg)
+        get_smtp_connection(config).send_message(msg)
         
         print("✅ Quantum-secure email sent successfully!")
         print(f"📝 Key ID: {key_id}")
-        print(f"🔐 Encryption: AES-256-GCM with QKD-derived key")
+        print(f"🔐 Encryption: {encrypted['algorithm']} with QKD-derived key")
         
         return {
             'status': 'success',
@@ -155,10 +251,14 @@ QuMail - Quantum-Secure Email Communication
             'error': str(e)
         }
 
+def send_encrypted_emails(to_addresses, subject, body, config):
+    """Send the message to several recipients, each under its own QKD key, over one SMTP session"""
+    return [send_encrypted_email(to_address, subject, body, config) for to_address in to_addresses]
+
 def main():
     """Main function"""
     parser = argparse.ArgumentParser(description='Send quantum-secure email')
-    parser.add_argument('--to', required=True, help='Recipient email address')
+    parser.add_argument('--to', required=True, nargs='+', help='Recipient email address(es)')
     parser.add_argument('--subject', required=True, help='Email subject')
     parser.add_argument('--body', required=True, help='Email body')
     parser.add_argument('--config', default=CONFIG_FILE, help='Configuration file path')
@@ -177,13 +277,12 @@ def main():
         print(f"❌ Failed to load configuration: {e}")
         return
     
-    # Send encrypted email
-    result = send_encrypted_email(args.to, args.subject, args.body, config)
-    
-    if result['status'] == 'success':
-        print(f"\n🎉 Message sent with quantum security!")
-    else:
-        print(f"\n💥 Send failed: {result['error']}")
+    # Send encrypted email(s); the SMTP session is set up once and reused per recipient
+    for result in send_encrypted_emails(args.to, args.subject, args.body, config):
+        if result['status'] == 'success':
+            print(f"\n🎉 Message sent with quantum security!")
+        else:
+            print(f"\n💥 Send failed: {result['error']}")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -16,19 +16,29 @@ Environment Variables:
     IMAP_PASS=your_app_password
 
 Installation:
-    pip install pycryptodome requests python-dotenv
+    pip install cryptography requests python-dotenv orjson  # optional: pybase64
 """
 
-import imaplib
 import email
-import requests
+import email.policy
 import argparse
-import json
+import orjson
 import base64
+import binascii
+try:
+    from pybase64 import b64decode as _b64decode  # SIMD base64 for large bodies
+except ImportError:
+    _b64decode = binascii.a2b_base64
 import os
 import re
+import sys
+import threading
+import time
 from email.header import decode_header
-from Crypto.Cipher import AES
+from email.parser import BytesHeaderParser
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -36,7 +46,18 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Configuration
-QKD_API_BASE = 'http://localhost:5001'
+QKD_API_BASE = 'http://localhost:5001/api'  # Flask Key Manager (backend/app.py)
+DECRYPT_WORKERS = os.cpu_count() or 1
+MAX_BATCH_KEYS = 100  # matches the Key Manager's /api/get_keys limit
+STREAM_THRESHOLD = 1024 * 1024  # ciphertexts at least this large are decrypted in chunks
+STREAM_CHUNK_SIZE = 64 * 1024
+KEY_CACHE_SIZE = 512
+BODY_PREVIEW_BYTES = 4096  # enough for display_email's 500-character preview in any UTF-8
+# Header fields needed to list a message and tell whether it is QuMail-encrypted
+TRIAGE_FETCH = '(BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE X-QUMAIL-ENCRYPTED X-QUMAIL-KEY-ID X-QUMAIL-VERSION X-QUMAIL-TIMESTAMP)])'
+_HEADER_PARSER = BytesHeaderParser()  # stops at the blank line; no body decoding
+PAYLOAD_FILENAME = 'payload.qmail'  # binary ciphertext attachment used for large bodies
+PAYLOAD_RE = re.compile(r'--- ENCRYPTED PAYLOAD ---\s*\n(.*?)\n--- END ENCRYPTED PAYLOAD ---', re.DOTALL)
 
 def load_config():
     """Load IMAP configuration from environment variables"""
@@ -63,15 +84,85 @@ def load_config():
     
     return config
 
-def get_qkd_key(key_id):
-    """Retrieve QKD key from Key Manager"""
+# One keep-alive session for all Key Manager calls, sized for the decrypt workers.
+# Created on first use so that --help and config errors don't pay for importing requests.
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """Return the shared Key Manager session, creating it on first use"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            _session = requests.Session()
+            _session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=DECRYPT_WORKERS))
+        return _session
+
+# Keys are write-once, so a fetched key stays valid in-process until it expires
+_key_cache = OrderedDict()  # key_id -> (expires_epoch, key_b64)
+_key_cache_lock = threading.Lock()
+
+def _cached_key(key_id):
+    """Return a still-valid cached key, or None"""
+    with _key_cache_lock:
+        entry = _key_cache.get(key_id)
+        if entry is None:
+            return None
+        if time.time() > entry[0]:
+            del _key_cache[key_id]
+            return None
+        _key_cache.move_to_end(key_id)
+        return entry[1]
+
+def _cache_key(key_id, key_data):
+    """Remember a fetched key until the expiry the Key Manager reported"""
+    expires_at = key_data.get('expires_at')
+    if not expires_at:
+        return
+    expires_epoch = datetime.fromisoformat(expires_at.replace('Z', '+00:00')).timestamp()
+    with _key_cache_lock:
+        _key_cache[key_id] = (expires_epoch, key_data['key_b64'])
+        _key_cache.move_to_end(key_id)
+        while len(_key_cache) > KEY_CACHE_SIZE:
+            _key_cache.popitem(last=False)
+
+def prefetch_qkd_keys(key_ids):
+    """Retrieve many QKD keys with batched /api/get_keys calls; returns {key_id: key_b64}"""
+    import requests
+    key_ids = list(dict.fromkeys(key_ids))
+    keys = {}
+    for start in range(0, len(key_ids), MAX_BATCH_KEYS):
+        batch = key_ids[start:start + MAX_BATCH_KEYS]
+        try:
+            response = get_session().post(f'{QKD_API_BASE}/get_keys', json={'key_ids': batch}, timeout=10)
+        except requests.RequestException as e:
+            print(f"⚠️  Batch key retrieval failed, falling back to single lookups: {e}")
+            return keys
+        if response.status_code != 200:
+            print(f"⚠️  Batch key retrieval failed ({response.status_code}), falling back to single lookups")
+            return keys
+        for key_id, key_data in response.json()['key_data'].items():
+            keys[key_id] = key_data['key_b64']
+            _cache_key(key_id, key_data)
+    print(f"✅ Prefetched {len(keys)} of {len(key_ids)} QKD keys")
+    return keys
+
+def get_qkd_key(key_id, log=print):
+    """Retrieve QKD key from Key Manager, reporting progress through log"""
+    key_b64 = _cached_key(key_id)
+    if key_b64:
+        return key_b64
+    import requests
     try:
-        print(f"🔍 Retrieving QKD key: {key_id}")
-        response = requests.get(f'{QKD_API_BASE}/get_key/{key_id}', timeout=10)
+        log(f"🔍 Retrieving QKD key: {key_id}")
+        response = get_session().get(f'{QKD_API_BASE}/get_key/{key_id}', timeout=10)
         
         if response.status_code == 200:
             data = response.json()
-            print(f"✅ QKD key retrieved successfully")
+            log(f"✅ QKD key retrieved successfully")
+            _cache_key(key_id, data['key_data'])
             return data['key_data']['key_b64']
         elif response.status_code == 404:
             raise Exception("QKD key not found")
@@ -83,17 +174,64 @@ def get_qkd_key(key_id):
     except requests.RequestException as e:
         raise Exception(f"Failed to connect to QKD Key Manager at {QKD_API_BASE}: {e}")
 
+@lru_cache(maxsize=1024)
+def _get_aesgcm(key_bytes):
+    """Return a cached AESGCM so the AES key schedule is expanded once per key"""
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    return AESGCM(key_bytes)
+
+def _aesgcm_decrypt_chunked(key, nonce, ciphertext, tag):
+    """AES-GCM decrypt with a detached tag in cache-sized chunks, without joining ciphertext and tag"""
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    src = memoryview(ciphertext)
+    decryptor = Cipher(algorithms.AES(key), modes.GCM(nonce, tag)).decryptor()
+    out = bytearray(len(src) + 15)
+    dst = memoryview(out)
+    pos = 0
+    for start in range(0, len(src), STREAM_CHUNK_SIZE):
+        pos += decryptor.update_into(src[start:start + STREAM_CHUNK_SIZE], dst[pos:])
+    decryptor.finalize()  # raises InvalidTag if the message was tampered with
+    dst.release()
+    del out[pos:]
+    return out
+
+def _decrypt(key_b64, nonce, ciphertext, tag):
+    """AES-256-GCM decrypt ciphertext with a detached tag, streaming large messages"""
+    key = base64.b64decode(key_b64)
+    if len(ciphertext) >= STREAM_THRESHOLD:
+        plaintext = _aesgcm_decrypt_chunked(key[:32], nonce, ciphertext, tag)
+    else:
+        plaintext = _get_aesgcm(key[:32]).decrypt(nonce, ciphertext + tag, None)
+    return plaintext.decode('utf-8')
+
 def decrypt_message(ciphertext_b64, nonce_b64, tag_b64, key_b64):
     """Decrypt message using AES-256-GCM"""
     try:
+        return _decrypt(key_b64, _b64decode(nonce_b64), _b64decode(ciphertext_b64), _b64decode(tag_b64))
+    except Exception as e:
+        raise Exception(f"Decryption failed: {e}")
+
+def decrypt_payload(payload, key_b64, attachment=None):
+    """Decrypt an encrypted payload: packed ('blob'), in a binary attachment, or with separate ciphertext/nonce/tag fields"""
+    if 'blob' not in payload and 'attachment' not in payload:
+        return decrypt_message(payload['ciphertext'], payload['nonce'], payload['tag'], key_b64)
+    try:
+        if 'attachment' in payload:
+            if attachment is None:
+                raise ValueError(f"attachment {payload['attachment']} is missing")
+            buf = memoryview(attachment)
+        else:
+            # One decode for nonce || ciphertext || tag, then slice without copying the ciphertext
+            buf = memoryview(_b64decode(payload['blob']))
+        nonce_len, tag_len = payload.get('n', 12), payload.get('t', 16)
+        if len(buf) < nonce_len + tag_len:
+            raise ValueError("packed payload is truncated")
+        nonce, sealed = bytes(buf[:nonce_len]), buf[nonce_len:]
         key = base64.b64decode(key_b64)
-        ciphertext = base64.b64decode(ciphertext_b64)
-        nonce = base64.b64decode(nonce_b64)
-        tag = base64.b64decode(tag_b64)
-        
-        cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
-        plaintext = cipher.decrypt_and_verify(ciphertext, tag)
-        
+        if len(sealed) - tag_len >= STREAM_THRESHOLD:
+            plaintext = _aesgcm_decrypt_chunked(key[:32], nonce, sealed[:-tag_len], bytes(sealed[-tag_len:]))
+        else:
+            plaintext = _get_aesgcm(key[:32]).decrypt(nonce, sealed, None)
         return plaintext.decode('utf-8')
     except Exception as e:
         raise Exception(f"Decryption failed: {e}")
@@ -102,6 +240,9 @@ def decode_email_header(header):
     """Decode email header"""
     if not header:
         return ""
+    # Plain ASCII without RFC 2047 encoded words needs no decoding
+    if isinstance(header, str) and header.isascii() and '=?' not in header:
+        return header
     
     decoded_header = decode_header(header)
     return ''.join([
@@ -109,30 +250,65 @@ def decode_email_header(header):
         for text, encoding in decoded_header
     ])
 
-def extract_encrypted_payload(email_body):
+def extract_encrypted_payload(email_body, log=print):
     """Extract encrypted payload from email body"""
-    # Look for encrypted payload block
-    pattern = r'--- ENCRYPTED PAYLOAD ---\s*\n(.*?)\n--- END ENCRYPTED PAYLOAD ---'
-    match = re.search(pattern, email_body, re.DOTALL)
+    match = PAYLOAD_RE.search(email_body)
     
     if not match:
         return None
     
     try:
         payload_json = match.group(1).strip()
-        payload = json.loads(payload_json)
+        payload = orjson.loads(payload_json)
         return payload
-    except json.JSONDecodeError as e:
-        print(f"❌ Failed to parse encrypted payload: {e}")
+    except orjson.JSONDecodeError as e:
+        log(f"❌ Failed to parse encrypted payload: {e}")
         return None
 
-def fetch_emails(config, mailbox='INBOX', limit=10):
-    """Fetch emails from IMAP server"""
+@lru_cache(maxsize=None)
+def _tls_context():
+    """Same verifying TLS context as send_email.py; the scripts are standalone"""
+    import ssl
+    context = ssl.create_default_context()
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    return context
+
+def imap_sequence_set(message_ids):
+    """Collapse message numbers into an IMAP sequence set, e.g. [3, 5, 6, 7] -> '3,5:7'"""
+    numbers = sorted(int(msg_id) for msg_id in message_ids)
+    ranges = []
+    start = end = numbers[0]
+    for number in numbers[1:]:
+        if number == end + 1:
+            end = number
+            continue
+        ranges.append(f"{start}:{end}" if end > start else str(start))
+        start = end = number
+    ranges.append(f"{start}:{end}" if end > start else str(start))
+    return ','.join(ranges)
+
+def fetch_messages(imap, message_ids, parts='(BODY.PEEK[])'):
+    """Fetch several messages in one round trip; returns {msg_id: raw message bytes}"""
+    if not message_ids:
+        return {}
+    status, data = imap.fetch(imap_sequence_set(message_ids), parts)
+    if status != 'OK':
+        return {}
+    # Each message arrives as a (b'<id> (BODY[] {n}', payload) tuple followed by b')'
+    return {item[0].split(None, 1)[0]: item[1] for item in data if isinstance(item, tuple)}
+
+def fetch_emails(config, mailbox='INBOX', limit=10, all_bodies=True, on_key_ids=None):
+    """Fetch emails from IMAP server; with all_bodies=False only QuMail messages are downloaded in full.
+
+    on_key_ids, if given, is called with the QuMail key IDs found by the header
+    triage before the bodies are downloaded, so key retrieval can overlap it.
+    """
+    import imaplib
     try:
         print(f"📥 Connecting to IMAP server {config['imap_host']}:{config['imap_port']}")
         
         # Connect to IMAP server
-        with imaplib.IMAP4_SSL(config['imap_host'], config['imap_port']) as imap:
+        with imaplib.IMAP4_SSL(config['imap_host'], config['imap_port'], ssl_context=_tls_context()) as imap:
             imap.login(config['imap_user'], config['imap_pass'])
             imap.select(mailbox)
             
@@ -148,13 +324,26 @@ def fetch_emails(config, mailbox='INBOX', limit=10):
             print(f"📧 Found {len(message_ids)} recent emails")
             
             emails = []
+            if all_bodies:
+                raw_messages = fetch_messages(imap, message_ids)
+            else:
+                # Triage on headers alone, then download just the QuMail messages
+                raw_messages = fetch_messages(imap, message_ids, TRIAGE_FETCH)
+                qumail_headers = {}
+                for msg_id, raw_headers in raw_messages.items():
+                    headers = _HEADER_PARSER.parsebytes(raw_headers)
+                    if headers.get('X-QuMail-Encrypted') == 'AES-GCM':
+                        qumail_headers[msg_id] = headers
+                if on_key_ids is not None:
+                    on_key_ids([h['X-QuMail-Key-ID'] for h in qumail_headers.values() if h['X-QuMail-Key-ID']])
+                raw_messages.update(fetch_messages(imap, list(qumail_headers)))
             for msg_id in message_ids:
-                status, msg_data = imap.fetch(msg_id, '(RFC822)')
-                if status != 'OK':
+                raw_message = raw_messages.get(msg_id)
+                if raw_message is None:
                     continue
                 
                 # Parse email
-                email_message = email.message_from_bytes(msg_data[0][1])
+                email_message = email.message_from_bytes(raw_message, policy=email.policy.default)
                 
                 # Extract headers
                 subject = decode_email_header(email_message.get('Subject', ''))
@@ -168,14 +357,17 @@ def fetch_emails(config, mailbox='INBOX', limit=10):
                 timestamp = email_message.get('X-QuMail-Timestamp')
                 
                 # Extract body
-                body = ""
+                payload = b""
                 if email_message.is_multipart():
-                    for part in email_message.walk():
-                        if part.get_content_type() == "text/plain":
-                            body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                            break
+                    part = email_message.get_body(preferencelist=('plain',))
+                    if part is not None:
+                        payload = part.get_payload(decode=True)
                 else:
-                    body = email_message.get_payload(decode=True).decode('utf-8', errors='ignore')
+                    payload = email_message.get_payload(decode=True) or b""
+                # Standard mail is only shown as a 500-character preview; decode just its head
+                if not is_qumail:
+                    payload = payload[:BODY_PREVIEW_BYTES]
+                body = payload.decode('utf-8', errors='ignore')
                 
                 emails.append({
                     'id': msg_id.decode(),
@@ -187,6 +379,8 @@ def fetch_emails(config, mailbox='INBOX', limit=10):
                     'key_id': key_id,
                     'version': version,
                     'timestamp': timestamp,
+                    # Kept so a large body's attachment is only decoded if the message is decrypted
+                    'message': email_message if is_qumail and email_message.is_multipart() else None,
                     'decrypted': False,
                     'decrypted_body': None
                 })
@@ -196,87 +390,99 @@ def fetch_emails(config, mailbox='INBOX', limit=10):
     except Exception as e:
         raise Exception(f"Failed to fetch emails: {e}")
 
-def decrypt_qumail_email(email_data):
-    """Decrypt QuMail encrypted email"""
+def extract_payload_attachment(email_message):
+    """Return the binary ciphertext attachment a large QuMail body is sent with, or None"""
+    if email_message is None:
+        return None
+    return next((
+        part.get_content() for part in email_message.iter_attachments()
+        if part.get_filename() == PAYLOAD_FILENAME
+    ), None)
+
+def decrypt_qumail_email(email_data, key_cache=None, log=print):
+    """Decrypt QuMail encrypted email, using key_cache ({key_id: key_b64}) before the Key Manager.
+
+    Status lines go through log, so worker threads can buffer them per message.
+    """
     if not email_data['is_qumail']:
-        print(f"📝 Email '{email_data['subject']}' is not QuMail encrypted")
+        log(f"📝 Email '{email_data['subject']}' is not QuMail encrypted")
         return email_data
     
     try:
-        print(f"\n🔓 Decrypting QuMail email: {email_data['subject']}")
-        print(f"🔑 Key ID: {email_data['key_id']}")
+        log(f"\n🔓 Decrypting QuMail email: {email_data['subject']}")
+        log(f"🔑 Key ID: {email_data['key_id']}")
         
         # Extract encrypted payload from body
-        payload = extract_encrypted_payload(email_data['body'])
+        payload = extract_encrypted_payload(email_data['body'], log)
         if not payload:
             raise Exception("Could not extract encrypted payload from email body")
         
-        print(f"📦 Payload algorithm: {payload.get('algorithm', 'unknown')}")
+        log(f"📦 Payload algorithm: {payload.get('algorithm', 'unknown')}")
         
-        # Get QKD key
-        key_b64 = get_qkd_key(email_data['key_id'])
+        # Get QKD key; expired or missing keys fall through to get_qkd_key for its error
+        key_b64 = (key_cache or {}).get(email_data['key_id']) or get_qkd_key(email_data['key_id'], log)
         
         # Decrypt message
-        print("🔓 Decrypting with AES-256-GCM...")
-        decrypted_body = decrypt_message(
-            payload['ciphertext'],
-            payload['nonce'],
-            payload['tag'],
-            key_b64
-        )
+        log("🔓 Decrypting with AES-256-GCM...")
+        attachment = extract_payload_attachment(email_data.get('message')) if 'attachment' in payload else None
+        decrypted_body = decrypt_payload(payload, key_b64, attachment)
         
         # Update email data
         email_data['decrypted'] = True
         email_data['decrypted_body'] = decrypted_body
         
-        print("✅ Message decrypted successfully!")
+        log("✅ Message decrypted successfully!")
         
         return email_data
         
     except Exception as e:
-        print(f"❌ Failed to decrypt message: {e}")
+        log(f"❌ Failed to decrypt message: {e}")
         email_data['decrypt_error'] = str(e)
         return email_data
 
 def display_email(email_data, show_body=True):
     """Display email in formatted output"""
-    print("\n" + "="*70)
-    print(f"📧 Subject: {email_data['subject']}")
-    print(f"👤 From: {email_data['from']}")
-    print(f"📅 Date: {email_data['date']}")
+    # Build the whole entry and write it once instead of one print per line
+    lines = []
+    out = lines.append
+    out("\n" + "="*70)
+    out(f"📧 Subject: {email_data['subject']}")
+    out(f"👤 From: {email_data['from']}")
+    out(f"📅 Date: {email_data['date']}")
     
     if email_data['is_qumail']:
         if email_data['decrypted']:
-            print("🔓 Status: QuMail Encrypted (✅ Decrypted)")
-            print(f"🔑 Key ID: {email_data['key_id']}")
-            print(f"📦 Version: {email_data['version']}")
+            out("🔓 Status: QuMail Encrypted (✅ Decrypted)")
+            out(f"🔑 Key ID: {email_data['key_id']}")
+            out(f"📦 Version: {email_data['version']}")
         elif email_data.get('decrypt_error'):
-            print("❌ Status: QuMail Encrypted (❌ Decryption Failed)")
-            print(f"💥 Error: {email_data['decrypt_error']}")
+            out("❌ Status: QuMail Encrypted (❌ Decryption Failed)")
+            out(f"💥 Error: {email_data['decrypt_error']}")
         else:
-            print("🔒 Status: QuMail Encrypted (⏳ Not Decrypted)")
-            print(f"🔑 Key ID: {email_data['key_id']}")
+            out("🔒 Status: QuMail Encrypted (⏳ Not Decrypted)")
+            out(f"🔑 Key ID: {email_data['key_id']}")
     else:
-        print("📝 Status: Standard Email")
+        out("📝 Status: Standard Email")
     
     if show_body:
-        print("\n📄 Body:")
-        print("-" * 70)
+        out("\n📄 Body:")
+        out("-" * 70)
         
         if email_data['is_qumail'] and email_data['decrypted']:
             # Show decrypted content
-            print(email_data['decrypted_body'])
+            out(email_data['decrypted_body'])
         elif email_data['is_qumail'] and not email_data['decrypted']:
             # Show that it's encrypted
-            print("🔒 [ENCRYPTED CONTENT - Use --decrypt-all to decrypt]")
+            out("🔒 [ENCRYPTED CONTENT - Use --decrypt-all to decrypt]")
         else:
             # Show regular email (truncated)
             body = email_data['body'][:500]
             if len(email_data['body']) > 500:
                 body += '\n... [truncated]'
-            print(body)
+            out(body)
     
-    print("="*70)
+    out("="*70)
+    sys.stdout.write('\n'.join(lines) + '\n')
 
 def main():
     """Main function"""
@@ -300,8 +506,15 @@ def main():
     
     if args.check_inbox or args.decrypt_all:
         try:
-            # Fetch emails
-            emails = fetch_emails(config, limit=args.limit)
+            # Fetch emails; with header triage the key prefetch runs while the bodies download
+            key_prefetch = []
+            with ThreadPoolExecutor(max_workers=1) as key_executor:
+                def start_key_prefetch(key_ids):
+                    key_prefetch.append(key_executor.submit(prefetch_qkd_keys, key_ids))
+                
+                emails = fetch_emails(config, limit=args.limit, all_bodies=args.check_inbox,
+                                      on_key_ids=start_key_prefetch if args.decrypt_all else None)
+                key_cache = key_prefetch[0].result() if key_prefetch else None
             
             print(f"\n📊 Email Summary:")
             print(f"   Total emails: {len(emails)}")
@@ -309,12 +522,24 @@ def main():
             print(f"   QuMail encrypted: {qumail_count}")
             print(f"   Standard emails: {len(emails) - qumail_count}")
             
+            # Decrypt QuMail emails concurrently: key retrieval and AES-GCM
+            # run on worker threads instead of one message after another
+            if args.decrypt_all:
+                qumail_emails = [e for e in emails if e['is_qumail']]
+                if key_cache is None:
+                    key_cache = prefetch_qkd_keys(e['key_id'] for e in qumail_emails if e['key_id'])
+                def decrypt_buffered(email_data):
+                    lines = []
+                    decrypt_qumail_email(email_data, key_cache, log=lines.append)
+                    return lines
+                with ThreadPoolExecutor(max_workers=DECRYPT_WORKERS) as executor:
+                    # Each message's status lines are written in one go, in submission order
+                    for lines in executor.map(decrypt_buffered, qumail_emails):
+                        sys.stdout.write('\n'.join(lines) + '\n')
+            
             # Process emails
             for email_data in emails:
-                if args.decrypt_all and email_data['is_qumail']:
-                    email_data = decrypt_qumail_email(email_data)
-                
-                display_email(email_data, show_body=True)
+                display_email(email_data, show_body=args.check_inbox or email_data['is_qumail'])
             
             if qumail_count > 0 and not args.decrypt_all:
                 print(f"\n💡 Found {qumail_count} QuMail encrypted messages.")
@@ -7,36 +7,55 @@ The email body is encrypted using AES-256-GCM with QKD-derived keys.
 
 Usage:
     python send_email.py --to recipient@example.com --subject "Test" --body "Secret message"
+    python send_email.py --batch recipients.json --subject "Test" --body "Secret message"
 
 Environment Variables:
     SMTP_HOST=smtp.gmail.com
     SMTP_PORT=587
     SMTP_USER=your_email@gmail.com
     SMTP_PASS=your_app_password
+    SMTP_OAUTH_TOKEN=oauth2_access_token  # optional, replaces SMTP_PASS (XOAUTH2)
     SENDER_EMAIL=your_email@gmail.com
 
 Installation:
-    pip install pycryptodome requests python-dotenv
+    pip install cryptography requests python-dotenv orjson  # optional: pybase64
 """
 
 import smtplib
+import ssl
+import atexit
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import argparse
-import json
+import orjson
 import base64
+import binascii
+try:
+    from pybase64 import b64encode_as_string as _b64encode  # SIMD base64 for large bodies
+except ImportError:
+    def _b64encode(data):
+        return binascii.b2a_base64(data, newline=False).decode('ascii')
 import os
-from email.mime.text import MIMEText
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
-from Crypto.Cipher import AES
-from Crypto.Random import get_random_bytes
-from datetime import datetime
+from email.mime.text import MIMEText
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from functools import lru_cache
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
 # Configuration
-QKD_API_BASE = 'http://localhost:5001'
+QKD_API_BASE = 'http://localhost:5001/api'  # Flask Key Manager (backend/app.py)
+MAX_BATCH_KEYS = 100  # matches the Key Manager's /api/request_keys limit
+SMTPS_PORT = 465  # implicit-TLS submission port
+ATTACHMENT_THRESHOLD = 64 * 1024  # bodies of at least this many UTF-8 bytes ship their ciphertext as a binary attachment
+PAYLOAD_FILENAME = 'payload.qmail'
 
 def load_config():
     """Load SMTP configuration from environment variables"""
@@ -45,11 +64,12 @@ def load_config():
         'smtp_port': int(os.getenv('SMTP_PORT', 587)),
         'smtp_user': os.getenv('SMTP_USER', ''),
         'smtp_pass': os.getenv('SMTP_PASS', ''),
+        'smtp_oauth_token': os.getenv('SMTP_OAUTH_TOKEN', ''),
         'sender_email': os.getenv('SENDER_EMAIL', ''),
     }
     
-    # Validate required fields
-    required_fields = ['smtp_user', 'smtp_pass', 'sender_email']
+    # Validate required fields; an OAuth2 access token stands in for the password
+    required_fields = ['smtp_user', 'sender_email'] + ([] if config['smtp_oauth_token'] else ['smtp_pass'])
     missing_fields = [field for field in required_fields if not config[field]]
     
     if missing_fields:
@@ -60,17 +80,22 @@ def load_config():
       print("   SMTP_USER=your_email@gmail.com")
       print("   SMTP_PASS=your_app_password")
       print("   SENDER_EMAIL=your_email@gmail.com")
-      print("\n💡 For Gmail, use App Passwords instead of your regular password")
+      print("\n💡 For Gmail, use App Passwords instead of your regular password,")
+      print("   or set SMTP_OAUTH_TOKEN to an OAuth2 access token to authenticate with XOAUTH2")
       return None
 
     
     return config
 
+# One keep-alive session for all Key Manager calls; only connection failures are retried
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(max_retries=Retry(total=2, connect=2, read=0, status=0, other=0, backoff_factor=0.05)))
+
 def request_qkd_key(sender, recipient, lifetime=3600):
     """Request QKD key from Key Manager"""
     try:
         print(f"🔑 Requesting QKD key from {QKD_API_BASE}")
-        response = requests.post(f'{QKD_API_BASE}/request_key', json={
+        response = SESSION.post(f'{QKD_API_BASE}/request_key', json={
             'sender': sender,
             'recipient': recipient,
             'lifetime': lifetime
@@ -86,55 +111,143 @@ def request_qkd_key(sender, recipient, lifetime=3600):
     except requests.RequestException as e:
         raise Exception(f"Failed to connect to QKD Key Manager at {QKD_API_BASE}: {e}")
 
-def encrypt_message(plaintext, key_b64):
-    """Encrypt message using AES-256-GCM"""
+def request_qkd_keys(sender, recipients, lifetime=3600):
+    """Request one QKD key per recipient with batched /request_keys calls; returns [(key_id, key_b64)] in order"""
+    keys = []
+    try:
+        print(f"🔑 Requesting {len(recipients)} QKD keys from {QKD_API_BASE}")
+        for start in range(0, len(recipients), MAX_BATCH_KEYS):
+            batch = recipients[start:start + MAX_BATCH_KEYS]
+            response = SESSION.post(f'{QKD_API_BASE}/request_keys', json={'requests': [
+                {'sender': sender, 'recipient': recipient, 'lifetime': lifetime} for recipient in batch
+            ]}, timeout=10)
+            
+            if response.status_code != 200:
+                raise Exception(f"QKD key request failed: {response.text}")
+            keys.extend((key['key_id'], key['key_b64']) for key in response.json()['keys'])
+    except requests.RequestException as e:
+        raise Exception(f"Failed to connect to QKD Key Manager at {QKD_API_BASE}: {e}")
+    
+    print(f"✅ {len(keys)} QKD keys obtained")
+    return keys
+
+_HAS_ENCRYPT_INTO = hasattr(AESGCM, 'encrypt_into')  # cryptography >= 44
+
+@lru_cache(maxsize=1024)
+def _get_aesgcm(key_bytes):
+    """Return a cached AESGCM so the AES key schedule is expanded once per key"""
+    return AESGCM(key_bytes)
+
+def seal_message(plaintext, key_b64):
+    """Encrypt message using AES-256-GCM; returns the raw nonce || ciphertext || tag buffer and the nonce length"""
     try:
         key = base64.b64decode(key_b64)
-        cipher = AES.new(key, AES.MODE_GCM)
+        nonce = os.urandom(12)
         
-        ciphertext, tag = cipher.encrypt_and_digest(plaintext.encode('utf-8'))
+        data = plaintext.encode('utf-8')
+        aesgcm = _get_aesgcm(key[:32])
         
-        return {
-            'ciphertext': base64.b64encode(ciphertext).decode('utf-8'),
-            'nonce': base64.b64encode(cipher.nonce).decode('utf-8'),
-            'tag': base64.b64encode(tag).decode('utf-8')
-        }
+        # nonce || ciphertext || tag in one buffer, so the receiver decodes once
+        if _HAS_ENCRYPT_INTO:
+            # Encrypt straight into the packed buffer instead of concatenating afterwards
+            packed = bytearray(len(nonce) + len(data) + 16)
+            packed[:len(nonce)] = nonce
+            aesgcm.encrypt_into(nonce, data, None, memoryview(packed)[len(nonce):])
+        else:
+            packed = nonce + aesgcm.encrypt(nonce, data, None)
+        
+        return packed, len(nonce)
     except Exception as e:
         raise Exception(f"Encryption failed: {e}")
 
-def send_encrypted_email(to_address, subject, body, config):
-    """Send quantum-encrypted email via SMTP"""
+@lru_cache(maxsize=None)
+def _tls_context():
+    """Certificate-verifying TLS context shared by all connections, so the CA bundle is loaded once"""
+    context = ssl.create_default_context()
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    return context
+
+def _xoauth2(user, token):
+    """SASL XOAUTH2 responder for SMTP.auth"""
+    def authobject(challenge=None):
+        # A rejected token comes back as a 334 error challenge; an empty reply ends the exchange
+        return '' if challenge else f'user={user}\x01auth=Bearer {token}\x01\x01'
+    return authobject
+
+_smtp_connections = {}
+
+def get_smtp_connection(config):
+    """Return an authenticated SMTP connection, reused across sends while the server keeps it open"""
+    # Per thread, so parallel senders never share one SMTP conversation
+    conn_key = (config['smtp_host'], config['smtp_port'], config['smtp_user'], threading.get_ident())
+    server = _smtp_connections.pop(conn_key, None)
+    if server is not None:
+        try:
+            if server.noop()[0] == 250:
+                _smtp_connections[conn_key] = server
+                return server
+        except (smtplib.SMTPException, OSError):
+            pass
+        server.close()
+    
+    if config['smtp_port'] == SMTPS_PORT:
+        # Implicit TLS: the handshake starts on connect, no plaintext EHLO + STARTTLS round trip
+        server = smtplib.SMTP_SSL(config['smtp_host'], config['smtp_port'], context=_tls_context())
+    else:
+        server = smtplib.SMTP(config['smtp_host'], config['smtp_port'])
+    try:
+        if config['smtp_port'] != SMTPS_PORT:
+            server.starttls(context=_tls_context())
+        if config.get('smtp_oauth_token'):
+            server.ehlo_or_helo_if_needed()
+            server.auth('XOAUTH2', _xoauth2(config['smtp_user'], config['smtp_oauth_token']))
+        else:
+            server.login(config['smtp_user'], config['smtp_pass'])
+    except Exception:
+        server.close()
+        raise
+    _smtp_connections[conn_key] = server
+    return server
+
+@atexit.register
+def close_smtp_connections():
+    while _smtp_connections:
+        _, server = _smtp_connections.popitem()
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+def send_encrypted_email(to_address, subject, body, config, qkd_key=None):
+    """Send quantum-encrypted email via SMTP, with qkd_key ((key_id, key_b64)) if already obtained"""
     try:
         # Step 1: Request QKD key
         print(f"📧 Preparing to send encrypted email to {to_address}")
-        key_id, key_b64 = request_qkd_key(config['sender_email'], to_address)
+        key_id, key_b64 = qkd_key or request_qkd_key(config['sender_email'], to_address)
         
         # Step 2: Encrypt message
         print("🔐 Encrypting message with AES-256-GCM...")
-        encrypted = encrypt_message(body, key_b64)
+        packed, nonce_len = seal_message(body, key_b64)
+        # Large ciphertexts go in a binary attachment, base64-encoded (and line-wrapped) once by the MIME layer
+        as_attachment = len(packed) - nonce_len - 16 >= ATTACHMENT_THRESHOLD  # UTF-8 bytes, not characters
         
         # Step 3: Prepare email
-        msg = MIMEMultipart()
-        msg['From'] = config['sender_email']
-        msg['To'] = to_address
-        msg['Subject'] = subject
-        
-        # Add QuMail headers for identification
-        msg['X-QuMail-Encrypted'] = 'AES-GCM'
-        msg['X-QuMail-Key-ID'] = key_id
-        msg['X-QuMail-Version'] = '1.0'
-        msg['X-QuMail-Timestamp'] = datetime.utcnow().isoformat() + 'Z'
+        # One clock read; the display time is sliced from the ISO string instead of strftime
+        timestamp = datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
         
         # Create encrypted payload
         encrypted_payload = {
             'version': '1.0',
             'algorithm': 'AES-256-GCM',
             'key_id': key_id,
-            'ciphertext': encrypted['ciphertext'],
-            'nonce': encrypted['nonce'],
-            'tag': encrypted['tag'],
-            'timestamp': datetime.utcnow().isoformat() + 'Z'
+            'n': nonce_len,
+            't': 16,
+            'timestamp': timestamp
         }
+        if as_attachment:
+            encrypted_payload['attachment'] = PAYLOAD_FILENAME
+        else:
+            encrypted_payload['blob'] = _b64encode(packed)
         
         # Email body with encrypted data
         email_body = f"""This message was encrypted using QuMail quantum-secure encryption.
@@ -143,33 +256,48 @@ To decrypt this message, you need QuMail client software and access to the QKD k
 
 Key ID: {key_id}
 Algorithm: AES-256-GCM
-Encrypted at: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC
+Encrypted at: {timestamp[:10]} {timestamp[11:19]} UTC
 
 --- ENCRYPTED PAYLOAD ---
-{json.dumps(encrypted_payload, indent=2)}
+{orjson.dumps(encrypted_payload).decode('utf-8')}
 --- END ENCRYPTED PAYLOAD ---
 
 QuMail - Quantum-Secure Email Communication
 https://github.com/qumail/qumail
 """
         
-        msg.attach(MIMEText(email_body, 'plain'))
+        if as_attachment:
+            msg = MIMEMultipart()
+            msg.attach(MIMEText(email_body, 'plain'))
+            attachment = MIMEApplication(packed, 'octet-stream')
+            attachment.add_header('Content-Disposition', 'attachment', filename=PAYLOAD_FILENAME)
+            msg.attach(attachment)
+        else:
+            # Single text part; a multipart wrapper adds nothing without attachments
+            msg = MIMEText(email_body, 'plain')
+        msg['From'] = config['sender_email']
+        msg['To'] = to_address
+        msg['Subject'] = subject
+        
+        # Add QuMail headers for identification
+        msg['X-QuMail-Encrypted'] = 'AES-GCM'
+        msg['X-QuMail-Key-ID'] = key_id
+        msg['X-QuMail-Version'] = '1.0'
+        msg['X-QuMail-Timestamp'] = timestamp
         
         # Step 4: Send email via SMTP
         print(f"📤 Connecting to SMTP server {config['smtp_host']}:{config['smtp_port']}")
         
-        with smtplib.SMTP(config['smtp_host'], config['smtp_port']) as server:
-            server.starttls()
-            server.login(config['smtp_user'], config['smtp_pass'])
-            
-            print(f"📧 Sending encrypted email...")
-            server.send_message(msg)
+        server = get_smtp_connection(config)
+        print(f"📧 Sending encrypted email...")
+        server.send_message(msg)
         
-        print("✅ Quantum-secure email sent successfully!")
-        print(f"📝 Subject: {subject}")
-        print(f"📧 To: {to_address}")
-        print(f"🔑 Key ID: {key_id}")
-        print(f"🔐 Encryption: AES-256-GCM with QKD-derived key")
+        # One write per report, so concurrent workers never interleave their lines
+        print(f"✅ Quantum-secure email sent successfully!\n"
+              f"📝 Subject: {subject}\n"
+              f"📧 To: {to_address}\n"
+              f"🔑 Key ID: {key_id}\n"
+              f"🔐 Encryption: AES-256-GCM with QKD-derived key")
         
         return {
             'status': 'success',
@@ -185,15 +313,46 @@ https://github.com/qumail/qumail
             'error': str(e)
         }
 
+def send_encrypted_emails(to_addresses, subject, body, config, workers=1):
+    """Send the message to several recipients, each under its own QKD key, over one SMTP session per worker"""
+    qkd_keys = [None] * len(to_addresses)
+    if len(to_addresses) > 1:
+        # One Key Manager round trip per batch instead of one per recipient
+        try:
+            qkd_keys = request_qkd_keys(config['sender_email'], to_addresses)
+        except Exception as e:
+            print(f"⚠️  Batch key request failed, requesting keys one at a time: {e}")
+    
+    def send(job):
+        return send_encrypted_email(job[0], subject, body, config, job[1])
+    
+    jobs = list(zip(to_addresses, qkd_keys))
+    if workers <= 1 or len(jobs) <= 1:
+        return [send(job) for job in jobs]
+    with ThreadPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+        return list(executor.map(send, jobs))
+
 def main():
     """Main function"""
     parser = argparse.ArgumentParser(description='Send quantum-secure email via real SMTP')
-    parser.add_argument('--to', required=True, help='Recipient email address')
+    parser.add_argument('--to', nargs='+', default=[], help='Recipient email address(es)')
+    parser.add_argument('--batch', metavar='FILE', help='JSON file with a list of recipient addresses')
+    parser.add_argument('--workers', type=int, default=1, help='Parallel SMTP connections for multi-recipient sends')
     parser.add_argument('--subject', required=True, help='Email subject')
     parser.add_argument('--body', required=True, help='Email body (will be encrypted)')
     
     args = parser.parse_args()
     
+    recipients = list(args.to)
+    if args.batch:
+        with open(args.batch, 'rb') as f:
+            batch = orjson.loads(f.read())
+        if not isinstance(batch, list) or not all(isinstance(r, str) for r in batch):
+            parser.error('--batch file must contain a JSON list of email addresses')
+        recipients.extend(batch)
+    if not recipients:
+        parser.error('at least one recipient is required (--to or --batch)')
+    
     print("🔐 QuMail Email Sender")
     print("=" * 50)
     
@@ -202,22 +361,23 @@ def main():
     if not config:
         return 1
     
-    print(f"📤 SMTP Server: {config['smtp_host']}:{config['smtp_port']}")
-    print(f"👤 Sender: {config['sender_email']}")
-    print(f"🎯 Recipient: {args.to}")
-    print(f"📝 Subject: {args.subject}")
-    print(f"💬 Message: {args.body[:50]}{'...' if len(args.body) > 50 else ''}")
-    print()
+    print(f"📤 SMTP Server: {config['smtp_host']}:{config['smtp_port']}\n"
+          f"👤 Sender: {config['sender_email']}\n"
+          f"🎯 Recipient: {', '.join(recipients)}\n"
+          f"📝 Subject: {args.subject}\n"
+          f"💬 Message: {args.body[:50]}{'...' if len(args.body) > 50 else ''}\n")
     
-    # Send encrypted email
-    result = send_encrypted_email(args.to, args.subject, args.body, config)
+    # Send encrypted email(s); each worker sets up its SMTP session once and reuses it
+    results = send_encrypted_emails(recipients, args.subject, args.body, config, workers=args.workers)
+    failed = [result for result in results if result['status'] != 'success']
     
-    if result['status'] == 'success':
+    if not failed:
         print(f"\n🎉 Encrypted email sent successfully!")
         print(f"🔍 Check the recipient's inbox for the encrypted message")
         return 0
     else:
-        print(f"\n💥 Send failed: {result['error']}")
+        for result in failed:
+            print(f"\n💥 Send failed: {result['error']}")
         return 1
 
 if __name__ == '__main__':